@@ -1,41 +1,30 @@
 import os
-import threading
-import time
-import tempfile
-import queue
-from dataclasses import dataclass, asdict
-from typing import Optional, Any, Dict
+import io
+import base64
+import cProfile
+from typing import Optional, Any, Dict, Literal, Tuple
 
 from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from contextlib import asynccontextmanager
 
-from printer import print_image_from_bytes, print_image_from_path
-
-import socket
-
-# Configuration via environment variables
-PRINTER_MAC = os.getenv("PRINTER_MAC", "DC:0D:30:C1:01:35")
-PRINTER_RFCOMM_CHANNEL = os.getenv("PRINTER_RFCOMM_CHANNEL") # Optional explicit rfcomm channel
-CONNECT_RETRY_SEC = float(os.getenv("PRINTER_CONNECT_RETRY_SEC", "5"))
-
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    t = threading.Thread(target=_connector_loop, name="rfcomm-connector", daemon=True)
-    t.start()
-    w = threading.Thread(target=_print_worker_loop, name="print-worker", daemon=True)
-    w.start()
+import ipc
+from printer import (
+    image_lines_from_bytes,
+    open_image_from_bytes,
+    prepare_image,
+    resolve_orientation,
+)
 
-    yield
+# The printer itself is owned by printer_daemon.py, this app only parses
+# uploads, prepares images and forwards requests, so it can run with
+# several uvicorn workers.
 
-    _stop_event.set()
-    _worker_stop_event.set()
-    _disconnect_bt()
+Orientation = Literal["auto", "portrait", "landscape"]
 
-app = FastAPI(title="Phomemo Printer API", version="1.1.0", lifespan=lifespan)
+app = FastAPI(title="Phomemo Printer API", version="1.2.0")
 
 app.add_middleware(
     CORSMiddleware,
@@ -48,149 +37,60 @@ app.add_middleware(
 if os.path.isdir("web"):
     app.mount("/ui", StaticFiles(directory="web", html=True), name="ui")
 
-# Internal state
-_bt_sock: Optional[Any] = None
-_bt_channel: Optional[int] = None
-_last_error: Optional[str] = None
-_last_connect_attempt: Optional[float] = None
-_state_lock = threading.Lock()
-_stop_event = threading.Event()
-_worker_stop_event = threading.Event()
-
-
-@dataclass
-class PrintJob:
-    id: str
-    path: str
-    status: str = "queued"  # queued | printing | done | error
-    total: int = 0
-    done: int = 0
-    error: Optional[str] = None
-    created_at: float = time.time()
-
-
-_jobs: Dict[str, PrintJob] = {}
-_jobs_lock = threading.Lock()
-_job_queue: "queue.Queue[str]" = queue.Queue()
-
-
-class SocketWriter:
-    def __init__(self, sock: Any) -> None:
-        self.sock = sock
-
-    def write(self, b: bytes) -> int:
-        if not isinstance(b, (bytes, bytearray)):
-            raise TypeError("write() argument must be bytes-like")
-        self.sock.sendall(b)
-        return len(b)
-
-    def flush(self) -> None:  # for file-like compatibility
-        return None
-
-
-def _resolve_channel(mac: str) -> int:
-    # 1) env override
-    if PRINTER_RFCOMM_CHANNEL:
-        try:
-            return int(PRINTER_RFCOMM_CHANNEL)
-        except ValueError:
-            pass
-    # 2) Typical default channel for SPP
-    return 1
-
-
-def _is_connected() -> bool:
-    return _bt_sock is not None
-
-
-def _connect_bt_if_needed() -> None:
-    global _bt_sock, _bt_channel, _last_error
-    with _state_lock:
-        if _bt_sock is not None:
-            return
-        _last_connect_attempt = time.time()
-        try:
-            ch = _resolve_channel(PRINTER_MAC)
-            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
-            sock.connect((PRINTER_MAC, ch))
-            sock.settimeout(None)
-            _bt_sock = sock
-            _bt_channel = ch
-            _last_error = None
-        except Exception as e:
-            _bt_sock = None
-            _bt_channel = None
-            _last_error = f"Bluetooth connect failed: {e}"
-
-
-def _disconnect_bt() -> None:
-    global _bt_sock, _bt_channel, _last_error
-    with _state_lock:
-        if _bt_sock is not None:
-            try:
-                _bt_sock.close()
-            except Exception:
-                pass
-        _bt_sock = None
-        _bt_channel = None
-        _last_error = None
-
-
-def _connector_loop():
-    # Background loop that ensures Bluetooth socket stays connected
-    while not _stop_event.is_set():
-        try:
-            if not _is_connected():
-                _connect_bt_if_needed()
-        except Exception as e:
-            with _state_lock:
-                global _last_error
-                _last_error = f"Connector loop error: {e}"
-        _stop_event.wait(CONNECT_RETRY_SEC)
-
-
-def _print_worker_loop():
-    # Background worker that processes queued print jobs # AI generated
-    while not _worker_stop_event.is_set():
-        try:
-            job_id = _job_queue.get(timeout=0.2)
-        except queue.Empty:
-            continue
-        with _jobs_lock:
-            job = _jobs.get(job_id)
-        if not job:
-            continue
-        # Ensure BT connection
-        if not _is_connected():
-            _connect_bt_if_needed()
-        if not _is_connected():
-            with _jobs_lock:
-                job.status = "error"
-                job.error = _last_error or "Bluetooth not connected"
-            continue
-        try:
-            writer = SocketWriter(_bt_sock)  # type: ignore
-            def on_prog(done: int, total: int):
-                with _jobs_lock:
-                    job.done = done
-                    job.total = total
-                    job.status = "printing"
-            print_image_from_path(job.path, writer, on_progress=on_prog)
-            with _jobs_lock:
-                job.status = "done"
-        except Exception as e:
-            with _jobs_lock:
-                job.status = "error"
-                job.error = str(e)
-            # Drop connection to force reconnect next time
-            _disconnect_bt()
-        finally:
-            # Clean up temp file
-            try:
-                os.unlink(job.path)
-            except Exception:
-                pass
 
+async def _call(op: str, timeout: Optional[float] = ipc.DAEMON_TIMEOUT_SEC, **params: Any) -> Any:
+    # Forward a request to the printer daemon off the event loop
+    try:
+        return await run_in_threadpool(ipc.call, op, timeout, **params)
+    except ipc.DaemonError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail, headers=e.headers)
+
+
+def _prepare(content: bytes, orientation: str) -> Tuple[bytes, int, str, Dict[str, float]]:
+    # Decode, rotate, resize and dither here so the work spreads across HTTP
+    # workers, the daemon only reads back the 1-bit result
+    trace: Dict[str, float] = {}
+    try:
+        img = open_image_from_bytes(content, trace=trace)
+        orientation = resolve_orientation(img.width, img.height, orientation)
+        image = prepare_image(img, trace=trace, orientation=orientation)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue(), image.height, orientation, trace
+
+
+def _prepare_for_daemon(content: bytes, orientation: str, profile: bool) -> Dict[str, Any]:
+    # When /admin/profile is armed, profile preparation here as well and
+    # send it along, the daemon merges it with the print worker's profile
+    prof = cProfile.Profile() if profile else None
+    if prof is not None:
+        prof.enable()
+    try:
+        png, lines, orientation, trace = _prepare(content, orientation)
+    finally:
+        if prof is not None:
+            prof.disable()
+    return {
+        "image": base64.b64encode(png).decode("ascii"),
+        "lines": lines,
+        "orientation": orientation,
+        "trace": trace,
+        "profile": ipc.dump_profile(prof) if prof is not None else None,
+    }
+
+
+async def _submit(op: str, content: bytes, orientation: str, timeout: Optional[float]) -> Any:
+    # Header-only line count, so an overloaded queue rejects the upload
+    # before any decoding. The daemon checks the limits again when queueing.
+    try:
+        lines = image_lines_from_bytes(content, orientation=orientation)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    admit = await _call("admit", lines=lines)
+    params = await run_in_threadpool(_prepare_for_daemon, content, orientation, admit["profile"])
+    return await _call(op, timeout, **params)
 
 
 @app.get("/")
@@ -202,100 +102,59 @@ async def root():
 
 @app.get("/status")
 async def status():
-    with _state_lock:
-        running = _is_connected()
-        return JSONResponse(
-            {
-                "mac": PRINTER_MAC,
-                "channel": _bt_channel,
-                "connected": running,
-                "last_connect_attempt": _last_connect_attempt,
-                "last_error": _last_error,
-                "transport": "bluetooth-rfcomm-socket",
-            }
-        )
+    return JSONResponse(await _call("status"))
 
 
 @app.post("/connect")
 async def connect():
-    _connect_bt_if_needed()
-    if not _is_connected():
-        raise HTTPException(status_code=500, detail=_last_error or "not connected")
-    return {"ok": True}
+    # Bluetooth connect may take longer than a status request
+    return await _call("connect", timeout=None)
 
 
 @app.post("/disconnect")
 async def disconnect():
-    _disconnect_bt()
-    return {"ok": True}
+    return await _call("disconnect")
 
 
 @app.post("/print")
-async def print_image(file: UploadFile = File(...)):
+async def print_image(file: UploadFile = File(...), orientation: Orientation = "portrait"):
     # Valdidate content
     content = await file.read()
     if not content:
         raise HTTPException(status_code=400, detail="Empty file")
-
-    # Ensure connected
-    if not _is_connected():
-        _connect_bt_if_needed()
-    if not _is_connected():
-        raise HTTPException(status_code=503, detail=_last_error or "Bluetooth not connected")
-
-    try:
-        # Stream image to the Bluetooth socket
-        assert _bt_sock is not None
-        writer = SocketWriter(_bt_sock)
-        print_image_from_bytes(content, writer)
-        return {"ok": True}
-    except Exception as e:
-        # On failure, drop the socket to force a reconnect next time
-        _disconnect_bt()
-        raise HTTPException(status_code=500, detail=f"Print failed: {e}")
+    # Blocks until the daemon has printed the image, or answers 504 after
+    # SYNC_PRINT_TIMEOUT_SEC while the job keeps its place in the queue
+    return await _submit(
+        "print",
+        content,
+        orientation,
+        timeout=ipc.SYNC_PRINT_TIMEOUT_SEC + ipc.DAEMON_TIMEOUT_SEC,
+    )
 
 
 @app.post("/print-async")
-async def print_async(file: UploadFile = File(...)):
+async def print_async(file: UploadFile = File(...), orientation: Orientation = "portrait"):
     content = await file.read()
     if not content:
         raise HTTPException(status_code=400, detail="Empty file")
-    # Write to a temp file so worker can open it
-    try:
-        fd, path = tempfile.mkstemp(prefix="phomemo_", suffix=".img")
-        with os.fdopen(fd, "wb") as f:
-            f.write(content)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to store job file: {e}")
-
-    job_id = f"job_{int(time.time()*1000)}"
-    job = PrintJob(id=job_id, path=path)
-    with _jobs_lock:
-        _jobs[job_id] = job
-    _job_queue.put(job_id)
-    return {"job_id": job_id}
+    return await _submit("submit", content, orientation, timeout=ipc.DAEMON_TIMEOUT_SEC)
 
 
 @app.get("/jobs/{job_id}")
 async def job_status(job_id: str):
-    with _jobs_lock:
-        job = _jobs.get(job_id)
-        if not job:
-            raise HTTPException(status_code=404, detail="Job not found")
-        data = asdict(job)
-    total = data.get("total") or 0
-    done = data.get("done") or 0
-    data["percent"] = (done / total * 100.0) if total > 0 else 0.0
-    return JSONResponse(data)
+    return JSONResponse(await _call("job", job_id=job_id))
 
 
 @app.get("/jobs")
 async def jobs_list():
-    with _jobs_lock:
-        items = [asdict(j) for j in _jobs.values()]
-    items.sort(key=lambda x: x.get("created_at", 0), reverse=True)
-    for d in items:
-        t = d.get("total") or 0
-        dn = d.get("done") or 0
-        d["percent"] = (dn / t * 100.0) if t > 0 else 0.0
-    return JSONResponse({"jobs": items})
+    return JSONResponse(await _call("jobs"))
+
+
+@app.post("/admin/profile")
+async def profile_start(jobs: int = 1):
+    return await _call("profile_start", jobs=jobs)
+
+
+@app.get("/admin/profile")
+async def profile_result(sort: str = "cumulative", limit: int = 40):
+    return JSONResponse(await _call("profile_result", sort=sort, limit=limit))
@@ -0,0 +1,50 @@
+#!/usr/bin/env bash
+# Runs the printer daemon and the HTTP API side by side.
+# Signals are forwarded to both, and if either exits the other is stopped,
+# so the container goes down (and can be restarted) as a unit.
+set -u
+
+cd "$(dirname "$0")"
+
+SOCKET="${PRINTER_DAEMON_SOCKET:-/tmp/phomemo-printer.sock}"
+SOCKET_WAIT_SEC="${PRINTER_DAEMON_WAIT_SEC:-10}"
+
+daemon_pid=""
+api_pid=""
+
+stop() {
+    [ -n "$api_pid" ] && kill -TERM "$api_pid" 2>/dev/null
+    [ -n "$daemon_pid" ] && kill -TERM "$daemon_pid" 2>/dev/null
+}
+trap stop TERM INT
+
+# Run the venv binaries directly so signals reach them, not a uv wrapper
+.venv/bin/python printer_daemon.py &
+daemon_pid=$!
+
+# Do not serve requests before the daemon accepts connections
+for _ in $(seq $((SOCKET_WAIT_SEC * 10))); do
+    [ -S "$SOCKET" ] && break
+    if ! kill -0 "$daemon_pid" 2>/dev/null; then
+        wait "$daemon_pid"
+        exit $?
+    fi
+    sleep 0.1
+done
+if [ ! -S "$SOCKET" ]; then
+    echo "printer daemon did not create $SOCKET" >&2
+    stop
+    wait
+    exit 1
+fi
+
+# WEB_CONCURRENCY sets the number of uvicorn workers
+.venv/bin/uvicorn app:app --host 0.0.0.0 --port 8000 &
+api_pid=$!
+
+# Returns when either process exits, or early when a trapped signal arrives
+wait -n "$daemon_pid" "$api_pid"
+status=$?
+stop
+wait
+exit "$status"
@@ -0,0 +1,79 @@
+import base64
+import json
+import marshal
+import os
+import socket
+from typing import Any, BinaryIO, Dict, Optional
+
+# Unix socket shared by the printer daemon and the HTTP workers
+DAEMON_SOCKET = os.getenv("PRINTER_DAEMON_SOCKET", "/tmp/phomemo-printer.sock")
+# Timeout for short requests
+DAEMON_TIMEOUT_SEC = float(os.getenv("PRINTER_DAEMON_TIMEOUT_SEC", "10"))
+# How long a synchronous /print waits for its job before answering 504
+SYNC_PRINT_TIMEOUT_SEC = float(os.getenv("PRINTER_SYNC_PRINT_TIMEOUT_SEC", "600"))
+
+# Protocol: one request per connection, each message is a single line of JSON.
+# Request:  {"op": "...", "params": {...}}
+# Response: {"ok": true, "result": ...}
+#           {"ok": false, "status": 4xx/5xx, "detail": "...", "headers": {...}}
+
+
+class DaemonError(Exception):
+    # Carries an HTTP status so the API can pass errors through unchanged
+    def __init__(self, status: int, detail: str, headers: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.headers = headers
+
+
+class _ProfileDump:
+    # Stand-in for cProfile.Profile that pstats.Stats and Stats.add accept
+    def __init__(self, stats: Dict[Any, Any]) -> None:
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        return None
+
+
+def dump_profile(prof: Any) -> str:
+    # Serialise a finished cProfile.Profile so it can cross the socket
+    prof.create_stats()
+    return base64.b64encode(marshal.dumps(prof.stats)).decode("ascii")
+
+
+def load_profile(data: str) -> _ProfileDump:
+    return _ProfileDump(marshal.loads(base64.b64decode(data)))
+
+
+def write_message(f: BinaryIO, msg: Dict[str, Any]) -> None:
+    f.write(json.dumps(msg).encode("utf-8") + b"\n")
+    f.flush()
+
+
+def read_message(f: BinaryIO) -> Optional[Dict[str, Any]]:
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def call(op: str, timeout: Optional[float] = DAEMON_TIMEOUT_SEC, **params: Any) -> Any:
+    # Send one request to the daemon and return its result, raising DaemonError on failure
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(DAEMON_SOCKET)
+    except OSError as e:
+        raise DaemonError(503, f"Printer daemon unavailable: {e}")
+    try:
+        with sock, sock.makefile("rwb") as f:
+            write_message(f, {"op": op, "params": params})
+            resp = read_message(f)
+    except (OSError, ValueError) as e:
+        raise DaemonError(503, f"Printer daemon request failed: {e}")
+    if resp is None:
+        raise DaemonError(503, "Printer daemon closed the connection")
+    if not resp.get("ok"):
+        raise DaemonError(resp.get("status", 500), resp.get("detail", "Daemon error"), resp.get("headers"))
+    return resp.get("result")
@@ -1,16 +1,33 @@
-from typing import BinaryIO, Callable, Optional
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Dict, Iterator, Optional
 from PIL import Image
 import time
 
 # Printer constants
 PRINTER_WIDTH = 384  # dots
 MAX_MARKER_LINES = 256 # Height of a chunk between markers
+ORIENTATIONS = ("auto", "portrait", "landscape")
+# Shortest printed side, in dots, that auto orientation accepts (~12 mm at 203 dpi)
+MIN_LEGIBLE_DOTS = 96
 
 # Printer interface implementation is AI generated
 def _write(out: BinaryIO, data: bytes) -> None:
     out.write(data)
 
 
+@contextmanager
+def _timed(trace: Optional[Dict[str, float]], stage: str) -> Iterator[None]:
+    # Accumulate wall time spent in a stage into trace (seconds), if tracing
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace[stage] = trace.get(stage, 0.0) + (time.perf_counter() - start)
+
+
 def print_header(out: BinaryIO) -> None:
     _write(out, b"\x1b\x40\x1b\x61\x01\x1f\x11\x02\x04")
 
@@ -64,11 +81,71 @@ def _line_bytes(pixels, y: int, width: int) -> bytes:
     return bytes(row)
 
 
-def prepare_image(img: Image.Image, width: int = PRINTER_WIDTH) -> Image.Image:
-    # Resize preserving aspect ratio to printer width, convert to 1-bit
-    h = int(img.height * width / img.width)
-    img = img.resize(size=(width, h))
-    img = img.convert(mode="1")
+def scaled_height(img_width: int, img_height: int, width: int = PRINTER_WIDTH) -> int:
+    # Number of printed lines once scaled to the printer width
+    return int(img_height * width / img_width)
+
+
+def resolve_orientation(
+    img_width: int,
+    img_height: int,
+    orientation: str = "auto",
+    width: int = PRINTER_WIDTH,
+    min_dots: int = MIN_LEGIBLE_DOTS,
+) -> str:
+    # Turn "auto" into "portrait" or "landscape" (rotated 90 degrees).
+    # Auto picks the fewest printed lines, and so the fewest bytes sent,
+    # among the orientations whose printed short side is at least min_dots,
+    # so a wide label is not squeezed into a thin strip. Legibility depends
+    # on the printed size only, not on the source resolution.
+    if orientation not in ORIENTATIONS:
+        raise ValueError(f"orientation must be one of {', '.join(ORIENTATIONS)}")
+    if orientation != "auto":
+        return orientation
+    lines = {
+        "portrait": scaled_height(img_width, img_height, width),
+        "landscape": scaled_height(img_height, img_width, width),
+    }
+    legible = [o for o, n in lines.items() if min(width, n) >= min_dots]
+    return min(legible or lines, key=lambda o: lines[o])
+
+
+def image_lines_from_bytes(data: bytes, width: int = PRINTER_WIDTH, orientation: str = "portrait") -> int:
+    # Only reads the image header, no pixel decoding
+    from io import BytesIO
+
+    with Image.open(BytesIO(data)) as img:
+        orientation = resolve_orientation(img.width, img.height, orientation, width)
+        if orientation == "landscape":
+            return scaled_height(img.height, img.width, width)
+        return scaled_height(img.width, img.height, width)
+
+
+def open_image_from_bytes(data: bytes, trace: Optional[Dict[str, float]] = None) -> Image.Image:
+    from io import BytesIO
+
+    with _timed(trace, "decode"):
+        img = Image.open(BytesIO(data))
+        # Image.open is lazy, force the decode so it is measured here
+        img.load()
+    return img
+
+
+def prepare_image(
+    img: Image.Image,
+    width: int = PRINTER_WIDTH,
+    trace: Optional[Dict[str, float]] = None,
+    orientation: str = "portrait",
+) -> Image.Image:
+    # Rotate if needed, resize preserving aspect ratio to printer width, convert to 1-bit
+    orientation = resolve_orientation(img.width, img.height, orientation, width)
+    with _timed(trace, "resize"):
+        if orientation == "landscape":
+            img = img.transpose(Image.Transpose.ROTATE_90)
+        h = scaled_height(img.width, img.height, width)
+        img = img.resize(size=(width, h))
+    with _timed(trace, "dither"):
+        img = img.convert(mode="1")
     return img
 
 
@@ -76,9 +153,22 @@ def print_image_from_pil(
     img: Image.Image,
     out: BinaryIO,
     on_progress: Optional[Callable[[int, int], None]] = None,
+    trace: Optional[Dict[str, float]] = None,
+    orientation: str = "portrait",
 ) -> None:
-    image = prepare_image(img)
+    # trace, if given, collects per-stage durations in seconds:
+    # resize, dither, pack, transmit, pacing
+    image = prepare_image(img, trace=trace, orientation=orientation)
+    print_prepared_image(image, out, on_progress=on_progress, trace=trace)
 
+
+def print_prepared_image(
+    image: Image.Image,
+    out: BinaryIO,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    trace: Optional[Dict[str, float]] = None,
+) -> None:
+    # image must already come from prepare_image (1-bit, printer width)
     width = image.width
     height = image.height
     pixels = image.load()  # faster pixel access
@@ -86,29 +176,34 @@ def print_image_from_pil(
     remaining = height
     line = 0
     done = 0
-    print_header(out)
+    with _timed(trace, "transmit"):
+        print_header(out)
     while remaining > 0:
         lines = remaining if remaining <= MAX_MARKER_LINES else MAX_MARKER_LINES
-        print_marker(out, lines)
         # Build a whole block (lines * width_bytes) and write once
-        block = bytearray((width // 8) * lines)
-        offset = 0
-        for i in range(lines):
-            row = _line_bytes(pixels, line + i, width)
-            end = offset + len(row)
-            block[offset:end] = row
-            offset = end
-        _write(out, bytes(block))
+        with _timed(trace, "pack"):
+            block = bytearray((width // 8) * lines)
+            offset = 0
+            for i in range(lines):
+                row = _line_bytes(pixels, line + i, width)
+                end = offset + len(row)
+                block[offset:end] = row
+                offset = end
+        with _timed(trace, "transmit"):
+            print_marker(out, lines)
+            _write(out, bytes(block))
         # Without this delay the printer may drop data
         # - This delay may need to be adjusted based on printer model/speed
         # - Mine is M02, 4 seconds works reliably
-        time.sleep(4)
+        with _timed(trace, "pacing"):
+            time.sleep(4)
         # Probably no need to flush on each write
-        try:
-            out.flush()
-        except Exception:
-            # Not all file-like objects require flush
-            pass
+        with _timed(trace, "transmit"):
+            try:
+                out.flush()
+            except Exception:
+                # Not all file-like objects require flush
+                pass
         remaining -= lines
         line += lines
         done += lines
@@ -118,29 +213,51 @@ def print_image_from_pil(
             except Exception:
                 # Ignore progress callback failures
                 pass
-    print_footer(out)
-    try:
-        out.flush()
-    except Exception:
-        # Not all file-like objects require flush
-        pass
+    with _timed(trace, "transmit"):
+        print_footer(out)
+        try:
+            out.flush()
+        except Exception:
+            # Not all file-like objects require flush
+            pass
+
+
+def print_prepared_image_from_path(
+    path: str,
+    out: BinaryIO,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    trace: Optional[Dict[str, float]] = None,
+) -> None:
+    # Reading back a prepared 1-bit file is timed as "load", not "decode",
+    # so it does not mix with the decode of the original upload
+    with _timed(trace, "load"):
+        image = Image.open(path)
+        image.load()
+    if image.mode != "1" or image.width != PRINTER_WIDTH:
+        raise ValueError(f"{path} is not a prepared image")
+    return print_prepared_image(image, out, on_progress=on_progress, trace=trace)
 
 
 def print_image_from_path(
     path: str,
     out: BinaryIO,
     on_progress: Optional[Callable[[int, int], None]] = None,
+    trace: Optional[Dict[str, float]] = None,
+    orientation: str = "portrait",
 ) -> None:
-    img = Image.open(path)
-    return print_image_from_pil(img, out, on_progress=on_progress)
+    with _timed(trace, "decode"):
+        img = Image.open(path)
+        # Image.open is lazy, force the decode so it is measured here
+        img.load()
+    return print_image_from_pil(img, out, on_progress=on_progress, trace=trace, orientation=orientation)
 
 
 def print_image_from_bytes(
     data: bytes,
     out: BinaryIO,
     on_progress: Optional[Callable[[int, int], None]] = None,
+    trace: Optional[Dict[str, float]] = None,
+    orientation: str = "portrait",
 ) -> None:
-    from io import BytesIO
-
-    img = Image.open(BytesIO(data))
-    return print_image_from_pil(img, out, on_progress=on_progress)
+    img = open_image_from_bytes(data, trace=trace)
+    return print_image_from_pil(img, out, on_progress=on_progress, trace=trace, orientation=orientation)
@@ -0,0 +1,665 @@
+import os
+import io
+import base64
+import itertools
+import logging
+import math
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import queue
+import cProfile
+import pstats
+from dataclasses import dataclass, asdict, field
+from typing import Optional, Any, Dict, List
+from PIL import Image
+
+from ipc import (
+    DAEMON_SOCKET,
+    SYNC_PRINT_TIMEOUT_SEC,
+    DaemonError,
+    load_profile,
+    read_message,
+    write_message,
+)
+from printer import MAX_MARKER_LINES, PRINTER_WIDTH, print_prepared_image_from_path
+
+# Single process that owns the Bluetooth connection and the job queue.
+# HTTP workers (app.py) talk to it over the Unix socket in ipc.py, so
+# uvicorn can run several workers while only one process drives the printer.
+
+log = logging.getLogger("printer_daemon")
+
+# Configuration via environment variables
+PRINTER_MAC = os.getenv("PRINTER_MAC", "DC:0D:30:C1:01:35")
+PRINTER_RFCOMM_CHANNEL = os.getenv("PRINTER_RFCOMM_CHANNEL") # Optional explicit rfcomm channel
+CONNECT_RETRY_SEC = float(os.getenv("PRINTER_CONNECT_RETRY_SEC", "5"))
+# Admission limits for /print and /print-async, 0 disables a limit
+QUEUE_MAX_JOBS = int(os.getenv("PRINT_QUEUE_MAX_JOBS", "20"))
+QUEUE_MAX_LINES = int(os.getenv("PRINT_QUEUE_MAX_LINES", "20000"))
+# Initial guess for seconds per marker block, refined from finished jobs
+BLOCK_SECONDS = float(os.getenv("PRINT_BLOCK_SECONDS", "4.5"))
+
+# Internal state
+_bt_sock: Optional[Any] = None
+_bt_channel: Optional[int] = None
+_last_error: Optional[str] = None
+_last_connect_attempt: Optional[float] = None
+_state_lock = threading.Lock()
+_stop_event = threading.Event()
+_worker_stop_event = threading.Event()
+
+
+@dataclass
+class PrintJob:
+    id: str
+    path: str
+    status: str = "queued"  # queued | printing | done | error
+    total: int = 0  # printed lines
+    orientation: str = "portrait"  # as chosen when the image was prepared
+    done: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Position in _job_queue, the wall clock can repeat or step back
+    seq: int = 0
+    # Stage durations in seconds: decode, resize, dither (HTTP worker),
+    # queue_wait, load, pack, transmit, pacing (daemon)
+    trace: Dict[str, float] = field(default_factory=dict)
+
+
+_jobs: Dict[str, PrintJob] = {}
+_jobs_lock = threading.Lock()
+# Notified whenever a job finishes, used by synchronous prints
+_jobs_cond = threading.Condition(_jobs_lock)
+_job_queue: "queue.Queue[str]" = queue.Queue()
+# Next job sequence number, taken and queued under _jobs_lock so queue
+# order and seq order always agree
+_job_seq = itertools.count()
+# Measured seconds per marker block (EMA), guarded by _jobs_lock.
+# Printing time is dominated by the fixed pacing delay after each block,
+# so blocks are a better unit than raw lines for estimating.
+_block_seconds = BLOCK_SECONDS
+_BLOCK_SECONDS_ALPHA = 0.3
+
+# On-demand profiling of the print worker, armed via /admin/profile
+_profile_lock = threading.Lock()
+_profile_remaining = 0
+_profile_jobs: List[str] = []
+_profile_stats: Optional[pstats.Stats] = None
+# Profiles of image preparation sent by HTTP workers, by job id
+_http_profiles: Dict[str, Any] = {}
+
+
+def _take_profile_slot() -> bool:
+    global _profile_remaining
+    with _profile_lock:
+        if _profile_remaining <= 0:
+            return False
+        _profile_remaining -= 1
+        return True
+
+
+def _profile_armed() -> bool:
+    with _profile_lock:
+        return _profile_remaining > 0
+
+
+def _record_profile(job_id: str, prof: cProfile.Profile, http_profile: Optional[Any] = None) -> None:
+    global _profile_stats
+    with _profile_lock:
+        if _profile_stats is None:
+            _profile_stats = pstats.Stats(prof, stream=io.StringIO())
+        else:
+            _profile_stats.add(prof)
+        if http_profile is not None:
+            _profile_stats.add(http_profile)
+        _profile_jobs.append(job_id)
+
+
+def _blocks(lines: int) -> int:
+    return math.ceil(lines / MAX_MARKER_LINES) if lines > 0 else 0
+
+
+def _active_jobs_locked() -> List[PrintJob]:
+    # Queued or printing jobs in the order the worker takes them
+    active = [j for j in _jobs.values() if j.status in ("queued", "printing")]
+    active.sort(key=lambda j: j.seq)
+    return active
+
+
+def _eta_locked(job: PrintJob) -> Optional[float]:
+    # Seconds until job is expected to finish, None once it is finished
+    if job.status not in ("queued", "printing"):
+        return None
+    blocks = 0
+    for j in _active_jobs_locked():
+        blocks += _blocks(j.total - j.done)
+        if j is job:
+            break
+    return blocks * _block_seconds
+
+
+def _retry_after_locked(lines: int) -> Optional[float]:
+    # Seconds until a job of `lines` fits within the queue limits,
+    # None if it is admissible now
+    active = _active_jobs_locked()
+    count = len(active)
+    queued_lines = sum(j.total - j.done for j in active)
+
+    def fits() -> bool:
+        jobs_ok = QUEUE_MAX_JOBS <= 0 or count < QUEUE_MAX_JOBS
+        lines_ok = QUEUE_MAX_LINES <= 0 or queued_lines + lines <= QUEUE_MAX_LINES
+        return jobs_ok and lines_ok
+
+    if fits():
+        return None
+    wait = 0.0
+    for j in active:
+        wait += _blocks(j.total - j.done) * _block_seconds
+        count -= 1
+        queued_lines -= j.total - j.done
+        if fits():
+            break
+    return max(wait, 1.0)
+
+
+def _admit_locked(lines: int) -> None:
+    # Raise unless a job of `lines` fits within the queue limits right now
+    if QUEUE_MAX_LINES > 0 and lines > QUEUE_MAX_LINES:
+        raise DaemonError(413, f"Image needs {lines} lines, limit is {QUEUE_MAX_LINES}")
+    retry_after = _retry_after_locked(lines)
+    if retry_after is not None:
+        raise DaemonError(
+            429,
+            "Print queue is full",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+def _record_block_time_locked(blocks: int, seconds: float) -> None:
+    # Fold a finished job into the seconds-per-block estimate
+    global _block_seconds
+    if blocks > 0:
+        measured = seconds / blocks
+        _block_seconds += _BLOCK_SECONDS_ALPHA * (measured - _block_seconds)
+
+
+def _decode_image(image: str, lines: int) -> bytes:
+    # Check the payload is a prepared image of the announced height before
+    # it becomes a job, so a bad request cannot leave a broken job behind
+    try:
+        data = base64.b64decode(image, validate=True)
+        with Image.open(io.BytesIO(data)) as img:
+            mode, size = img.mode, img.size
+    except Exception:
+        raise DaemonError(400, "Image must be a base64 encoded PNG")
+    if mode != "1" or size != (PRINTER_WIDTH, lines):
+        raise DaemonError(400, f"Image is not a prepared {lines} line image")
+    return data
+
+
+def _store_image(data: bytes) -> str:
+    # The daemon owns job files: HTTP workers send the prepared PNG itself,
+    # so a client can never point the daemon at an arbitrary path
+    fd, path = tempfile.mkstemp(prefix="phomemo_", suffix=".png")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _job_dict_locked(job: PrintJob) -> Dict[str, Any]:
+    data = asdict(job)
+    total = data.get("total") or 0
+    done = data.get("done") or 0
+    data["percent"] = (done / total * 100.0) if total > 0 else 0.0
+    data["eta_seconds"] = _eta_locked(job)
+    return data
+
+
+def _new_job_locked(
+    path: str,
+    lines: int,
+    orientation: str,
+    trace: Optional[Dict[str, float]],
+) -> PrintJob:
+    job_id = f"job_{int(time.time()*1000)}"
+    # Several HTTP workers may submit within the same millisecond
+    n = 1
+    while job_id in _jobs:
+        job_id = f"job_{int(time.time()*1000)}_{n}"
+        n += 1
+    job = PrintJob(
+        id=job_id,
+        path=path,
+        total=lines,
+        orientation=orientation,
+        seq=next(_job_seq),
+        trace=dict(trace or {}),
+    )
+    _jobs[job_id] = job
+    return job
+
+
+class SocketWriter:
+    def __init__(self, sock: Any) -> None:
+        self.sock = sock
+
+    def write(self, b: bytes) -> int:
+        if not isinstance(b, (bytes, bytearray)):
+            raise TypeError("write() argument must be bytes-like")
+        self.sock.sendall(b)
+        return len(b)
+
+    def flush(self) -> None:  # for file-like compatibility
+        return None
+
+
+def _resolve_channel(mac: str) -> int:
+    # 1) env override
+    if PRINTER_RFCOMM_CHANNEL:
+        try:
+            return int(PRINTER_RFCOMM_CHANNEL)
+        except ValueError:
+            pass
+    # 2) Typical default channel for SPP
+    return 1
+
+
+def _is_connected() -> bool:
+    return _bt_sock is not None
+
+
+def _connect_bt_if_needed() -> None:
+    global _bt_sock, _bt_channel, _last_error, _last_connect_attempt
+    with _state_lock:
+        if _bt_sock is not None:
+            return
+        _last_connect_attempt = time.time()
+        try:
+            ch = _resolve_channel(PRINTER_MAC)
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+            sock.connect((PRINTER_MAC, ch))
+            sock.settimeout(None)
+            _bt_sock = sock
+            _bt_channel = ch
+            _last_error = None
+        except Exception as e:
+            _bt_sock = None
+            _bt_channel = None
+            _last_error = f"Bluetooth connect failed: {e}"
+
+
+def _disconnect_bt() -> None:
+    global _bt_sock, _bt_channel, _last_error
+    with _state_lock:
+        if _bt_sock is not None:
+            try:
+                _bt_sock.close()
+            except Exception:
+                pass
+        _bt_sock = None
+        _bt_channel = None
+        _last_error = None
+
+
+def _connector_loop():
+    # Background loop that ensures Bluetooth socket stays connected
+    while not _stop_event.is_set():
+        try:
+            if not _is_connected():
+                _connect_bt_if_needed()
+        except Exception as e:
+            with _state_lock:
+                global _last_error
+                _last_error = f"Connector loop error: {e}"
+        _stop_event.wait(CONNECT_RETRY_SEC)
+
+
+def _run_job(job: PrintJob) -> None:
+    with _jobs_lock:
+        job.started_at = time.time()
+        job.trace["queue_wait"] = job.started_at - job.created_at
+        # Printer fills a local copy, merged back into the job under the lock
+        trace = dict(job.trace)
+    with _profile_lock:
+        http_profile = _http_profiles.pop(job.id, None)
+    prof = None
+    try:
+        # Ensure BT connection, inside the try so the job file is cleaned up
+        if not _is_connected():
+            _connect_bt_if_needed()
+        if not _is_connected():
+            with _jobs_lock:
+                job.status = "error"
+                job.error = _last_error or "Bluetooth not connected"
+            return
+        prof = cProfile.Profile() if _take_profile_slot() else None
+        # Measured from here so reconnect time does not skew the block estimate
+        print_start = time.time()
+        writer = SocketWriter(_bt_sock)  # type: ignore
+        def on_prog(done: int, total: int):
+            with _jobs_lock:
+                job.done = done
+                job.total = total
+                job.status = "printing"
+                job.trace.update(trace)
+        if prof is not None:
+            prof.enable()
+        try:
+            print_prepared_image_from_path(job.path, writer, on_progress=on_prog, trace=trace)
+        finally:
+            if prof is not None:
+                prof.disable()
+        with _jobs_lock:
+            job.status = "done"
+            _record_block_time_locked(_blocks(job.total), time.time() - print_start)
+    except Exception as e:
+        with _jobs_lock:
+            job.status = "error"
+            job.error = str(e)
+        # Drop connection to force reconnect next time
+        _disconnect_bt()
+    finally:
+        with _jobs_lock:
+            job.trace.update(trace)
+            job.finished_at = time.time()
+            _jobs_cond.notify_all()
+        if prof is not None:
+            try:
+                _record_profile(job.id, prof, http_profile)
+            except Exception:
+                log.exception("Failed to record profile of %s", job.id)
+        # Clean up temp file
+        try:
+            os.unlink(job.path)
+        except Exception:
+            pass
+
+
+def _print_worker_loop():
+    # Background worker that processes queued print jobs # AI generated
+    while not _worker_stop_event.is_set():
+        try:
+            job_id = _job_queue.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        with _jobs_lock:
+            job = _jobs.get(job_id)
+        if not job:
+            continue
+        try:
+            _run_job(job)
+        except Exception:
+            # Never let one job stop the worker, every later job and
+            # waiting synchronous print depends on it
+            log.exception("Print worker failed on %s", job.id)
+            with _jobs_cond:
+                if job.status in ("queued", "printing"):
+                    job.status = "error"
+                    job.error = "Internal error in print worker"
+                job.finished_at = time.time()
+                _jobs_cond.notify_all()
+            try:
+                os.unlink(job.path)
+            except Exception:
+                pass
+
+
+# IPC operations, one per request "op". Errors are raised as DaemonError.
+
+def op_status() -> Dict[str, Any]:
+    with _state_lock:
+        return {
+            "mac": PRINTER_MAC,
+            "channel": _bt_channel,
+            "connected": _is_connected(),
+            "last_connect_attempt": _last_connect_attempt,
+            "last_error": _last_error,
+            "transport": "bluetooth-rfcomm-socket",
+        }
+
+
+def op_connect() -> Dict[str, Any]:
+    _connect_bt_if_needed()
+    if not _is_connected():
+        raise DaemonError(500, _last_error or "not connected")
+    return {"ok": True}
+
+
+def op_disconnect() -> Dict[str, Any]:
+    _disconnect_bt()
+    return {"ok": True}
+
+
+def op_admit(lines: int) -> Dict[str, Any]:
+    # Cheap check from the header line count before an HTTP worker spends
+    # time preparing the image. _queue_job checks again to close the race.
+    with _jobs_lock:
+        _admit_locked(lines)
+    return {"ok": True, "profile": _profile_armed()}
+
+
+def _queue_job(
+    image: str,
+    lines: int,
+    orientation: str,
+    trace: Optional[Dict[str, float]],
+    profile: Optional[str],
+) -> PrintJob:
+    data = _decode_image(image, lines)
+    http_profile = None
+    if profile is not None:
+        try:
+            # Building the Stats validates the payload before it is merged
+            http_profile = pstats.Stats(load_profile(profile), stream=io.StringIO())
+        except Exception:
+            raise DaemonError(400, "Invalid profile data")
+    path = _store_image(data)
+    job = None
+    try:
+        with _jobs_lock:
+            _admit_locked(lines)
+            job = _new_job_locked(path, lines, orientation, trace)
+            # The worker looks up the profile once it takes the job
+            if http_profile is not None:
+                with _profile_lock:
+                    _http_profiles[job.id] = http_profile
+            _job_queue.put(job.id)
+    except BaseException:
+        # Nothing may stay behind that is not on the queue
+        if job is not None:
+            with _jobs_lock:
+                _jobs.pop(job.id, None)
+            with _profile_lock:
+                _http_profiles.pop(job.id, None)
+        os.unlink(path)
+        raise
+    return job
+
+
+def op_submit(
+    image: str,
+    lines: int,
+    orientation: str = "portrait",
+    trace: Optional[Dict[str, float]] = None,
+    profile: Optional[str] = None,
+) -> Dict[str, Any]:
+    # Queue a prepared image (base64 PNG from prepare_image).
+    # It is already rotated, orientation is only recorded on the job.
+    job = _queue_job(image, lines, orientation, trace, profile)
+    with _jobs_lock:
+        eta = _eta_locked(job)
+    return {"job_id": job.id, "lines": lines, "orientation": orientation, "eta_seconds": eta}
+
+
+def op_print(
+    image: str,
+    lines: int,
+    orientation: str = "portrait",
+    trace: Optional[Dict[str, float]] = None,
+    profile: Optional[str] = None,
+) -> Dict[str, Any]:
+    # Synchronous print: goes through the queue so it never interleaves
+    # with another job on the socket, and returns once it has finished
+    if not _is_connected():
+        _connect_bt_if_needed()
+    if not _is_connected():
+        raise DaemonError(503, _last_error or "Bluetooth not connected")
+    job = _queue_job(image, lines, orientation, trace, profile)
+    with _jobs_cond:
+        finished = _jobs_cond.wait_for(
+            lambda: job.status in ("done", "error"), timeout=SYNC_PRINT_TIMEOUT_SEC
+        )
+        if not finished:
+            # The job stays queued, the caller can follow it like an async one
+            raise DaemonError(504, f"Print still in progress, see /jobs/{job.id}")
+        if job.status == "error":
+            raise DaemonError(500, f"Print failed: {job.error}")
+    return {"ok": True, "lines": lines, "orientation": orientation}
+
+
+def op_job(job_id: str) -> Dict[str, Any]:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if not job:
+            raise DaemonError(404, "Job not found")
+        return _job_dict_locked(job)
+
+
+def op_jobs() -> Dict[str, Any]:
+    with _jobs_lock:
+        items = [_job_dict_locked(j) for j in _jobs.values()]
+    items.sort(key=lambda x: x.get("seq", 0), reverse=True)
+    return {"jobs": items}
+
+
+def op_profile_start(jobs: int = 1) -> Dict[str, Any]:
+    # Profile the next `jobs` print jobs, discarding any previous results
+    global _profile_remaining, _profile_stats
+    if jobs < 1:
+        raise DaemonError(400, "jobs must be >= 1")
+    with _profile_lock:
+        _profile_remaining = jobs
+        _profile_jobs.clear()
+        _http_profiles.clear()
+        _profile_stats = None
+    return {"ok": True, "remaining": jobs}
+
+
+def op_profile_result(sort: str = "cumulative", limit: int = 40) -> Dict[str, Any]:
+    with _profile_lock:
+        remaining = _profile_remaining
+        jobs = list(_profile_jobs)
+        report = None
+        if _profile_stats is not None:
+            stream = io.StringIO()
+            _profile_stats.stream = stream
+            try:
+                _profile_stats.sort_stats(sort).print_stats(limit)
+            except KeyError:
+                raise DaemonError(400, f"Unknown sort key: {sort}")
+            report = stream.getvalue()
+    return {"remaining": remaining, "jobs": jobs, "profile": report}
+
+
+_OPS = {
+    "status": op_status,
+    "connect": op_connect,
+    "disconnect": op_disconnect,
+    "admit": op_admit,
+    "submit": op_submit,
+    "print": op_print,
+    "job": op_job,
+    "jobs": op_jobs,
+    "profile_start": op_profile_start,
+    "profile_result": op_profile_result,
+}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        try:
+            req = read_message(self.rfile)
+        except ValueError:
+            write_message(self.wfile, {"ok": False, "status": 400, "detail": "Malformed request"})
+            return
+        if req is None:
+            return
+        if not isinstance(req, dict) or not isinstance(req.get("params", {}), dict):
+            write_message(self.wfile, {"ok": False, "status": 400, "detail": "Malformed request"})
+            return
+        fn = _OPS.get(req.get("op"))
+        if fn is None:
+            write_message(self.wfile, {"ok": False, "status": 400, "detail": f"Unknown op: {req.get('op')}"})
+            return
+        try:
+            resp = {"ok": True, "result": fn(**req.get("params", {}))}
+        except DaemonError as e:
+            resp = {"ok": False, "status": e.status, "detail": e.detail, "headers": e.headers}
+        except Exception as e:
+            resp = {"ok": False, "status": 500, "detail": f"Daemon error: {e}"}
+        try:
+            write_message(self.wfile, resp)
+        except OSError:
+            # Client went away, e.g. an HTTP request was cancelled
+            pass
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def _claim_socket(path: str) -> None:
+    # Refuse to start next to a live daemon, otherwise remove a stale socket
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise SystemExit(f"Printer daemon already running on {path}")
+    finally:
+        probe.close()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    _claim_socket(DAEMON_SOCKET)
+    # Only local processes in the same group may talk to the printer.
+    # Set through the umask so the socket is never created with a looser mode.
+    old_umask = os.umask(0o117)
+    try:
+        server = _Server(DAEMON_SOCKET, _RequestHandler)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    t = threading.Thread(target=_connector_loop, name="rfcomm-connector", daemon=True)
+    t.start()
+    w = threading.Thread(target=_print_worker_loop, name="print-worker", daemon=True)
+    w.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.unlink(DAEMON_SOCKET)
+        except OSError:
+            pass
+        _stop_event.set()
+        _worker_stop_event.set()
+        _disconnect_bt()
+
+
+if __name__ == "__main__":
+    main()
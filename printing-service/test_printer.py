@@ -12,7 +12,12 @@ from printer import (
     print_footer,
     _line_bytes,
     prepare_image,
+    scaled_height,
+    image_lines_from_bytes,
+    open_image_from_bytes,
+    resolve_orientation,
     print_image_from_pil,
+    print_prepared_image_from_path,
     print_image_from_path,
     print_image_from_bytes,
     PRINTER_WIDTH,
@@ -109,6 +114,89 @@ class TestPrinterFunctions(unittest.TestCase):
         self.assertEqual(prepared_img.height, expected_height)
         self.assertEqual(prepared_img.mode, "1")
 
+    def test_image_lines_from_bytes(self):
+        buf = BytesIO()
+        self.dummy_image.save(buf, format="PNG")
+
+        lines = image_lines_from_bytes(buf.getvalue())
+
+        self.assertEqual(lines, scaled_height(self.dummy_image.width, self.dummy_image.height))
+        self.assertEqual(lines, prepare_image(self.dummy_image).height)
+
+    def test_open_image_from_bytes(self):
+        buf = BytesIO()
+        self.dummy_image.save(buf, format="PNG")
+        trace = {}
+
+        img = open_image_from_bytes(buf.getvalue(), trace=trace)
+
+        self.assertEqual(img.size, self.dummy_image.size)
+        self.assertIn("decode", trace)
+
+    def test_resolve_orientation(self):
+        # Explicit orientations are kept as is
+        self.assertEqual(resolve_orientation(1000, 100, "portrait"), "portrait")
+        self.assertEqual(resolve_orientation(100, 1000, "landscape"), "landscape")
+        with self.assertRaises(ValueError):
+            resolve_orientation(100, 100, "sideways")
+
+        # Wide label: portrait would squeeze it into a thin strip
+        self.assertEqual(resolve_orientation(2000, 300, "auto"), "landscape")
+        # Tall, narrow strip: landscape would be too thin
+        self.assertEqual(resolve_orientation(PRINTER_WIDTH, 2000, "auto"), "portrait")
+        # Wide but short: rotating would add lines
+        self.assertEqual(resolve_orientation(200, 50, "auto"), "portrait")
+        # Tall image: rotating saves lines and stays legible
+        self.assertEqual(resolve_orientation(PRINTER_WIDTH, 600, "auto"), "landscape")
+        # Stricter floor keeps the wide label from being printed as a strip
+        self.assertEqual(resolve_orientation(200, 50, "auto", min_dots=100), "landscape")
+
+    def test_resolve_orientation_typical_sizes(self):
+        # Source resolution does not matter, only the aspect ratio:
+        # landscape photos and screenshots print upright with fewer lines,
+        # portrait ones are rotated for the same reason
+        for size, expected, lines in [
+            ((800, 600), "portrait", 288),
+            ((1024, 768), "portrait", 288),
+            ((1920, 1080), "portrait", 216),
+            ((4000, 3000), "portrait", 288),
+            ((6000, 4000), "portrait", 256),
+            ((600, 800), "landscape", 288),
+            ((1080, 1920), "landscape", 216),
+            ((3000, 4000), "landscape", 288),
+            ((1000, 1000), "portrait", 384),
+        ]:
+            with self.subTest(size=size):
+                orientation = resolve_orientation(*size, "auto")
+                self.assertEqual(orientation, expected)
+                w, h = size if orientation == "portrait" else size[::-1]
+                self.assertEqual(scaled_height(w, h), lines)
+                # Never more lines than the other orientation
+                self.assertLessEqual(lines, min(scaled_height(*size), scaled_height(*size[::-1])))
+
+    def test_prepare_image_landscape(self):
+        prepared_img = prepare_image(self.dummy_image, orientation="landscape")
+
+        self.assertEqual(prepared_img.width, PRINTER_WIDTH)
+        self.assertEqual(
+            prepared_img.height,
+            scaled_height(self.dummy_image.height, self.dummy_image.width),
+        )
+
+    def test_header_lines_match_prepared_image(self):
+        # The API admits jobs on the header-only count, then prepares the
+        # image the same way as here. Both must agree for every orientation.
+        for size in [(2000, 300), (200, 50), (PRINTER_WIDTH, 600), (1000, 1500), (777, 333)]:
+            buf = BytesIO()
+            Image.new("RGB", size, color="white").save(buf, format="PNG")
+            data = buf.getvalue()
+            for orientation in ("auto", "portrait", "landscape"):
+                with self.subTest(size=size, orientation=orientation):
+                    img = open_image_from_bytes(data)
+                    resolved = resolve_orientation(img.width, img.height, orientation)
+                    prepared_img = prepare_image(img, orientation=resolved)
+                    self.assertEqual(image_lines_from_bytes(data, orientation=orientation), prepared_img.height)
+
     @patch("printer.time.sleep")
     @patch("printer._write")
     @patch("printer.print_header")
@@ -149,6 +237,32 @@ class TestPrinterFunctions(unittest.TestCase):
         # Verify sleep is called
         self.assertTrue(mock_sleep.called)
 
+    @patch("printer.time.sleep")
+    def test_print_image_from_pil_trace(self, mock_sleep):
+        trace = {}
+        small_img = Image.new("1", (PRINTER_WIDTH, MAX_MARKER_LINES + 10), color=0)
+
+        print_image_from_pil(small_img, self.mock_binary_io, trace=trace)
+
+        for stage in ("resize", "dither", "pack", "transmit", "pacing"):
+            self.assertIn(stage, trace)
+            self.assertGreaterEqual(trace[stage], 0.0)
+
+    @patch("printer.time.sleep")
+    def test_print_prepared_image_from_path(self, mock_sleep):
+        prepare_image(self.dummy_image).save(self.dummy_image_path)
+        trace = {}
+
+        print_prepared_image_from_path(self.dummy_image_path, self.mock_binary_io, trace=trace)
+
+        # Only reads the prepared image back, no second decode/resize/dither
+        self.assertIn("load", trace)
+        self.assertFalse({"decode", "resize", "dither"} & set(trace))
+
+    def test_print_prepared_image_from_path_rejects_raw_image(self):
+        with self.assertRaises(ValueError):
+            print_prepared_image_from_path(self.dummy_image_path, self.mock_binary_io)
+
     @patch("printer.Image.open")
     @patch("printer.print_image_from_pil")
     def test_print_image_from_path(self, mock_print_image_from_pil, mock_image_open):
@@ -160,7 +274,8 @@ class TestPrinterFunctions(unittest.TestCase):
 
         mock_image_open.assert_called_once_with(self.dummy_image_path)
         mock_print_image_from_pil.assert_called_once_with(
-            mock_image_instance, self.mock_binary_io, on_progress=mock_on_progress
+            mock_image_instance, self.mock_binary_io, on_progress=mock_on_progress, trace=None,
+            orientation="portrait",
         )
 
     @patch("printer.Image.open")
@@ -179,7 +294,8 @@ class TestPrinterFunctions(unittest.TestCase):
         mock_bytesio.assert_called_once_with(dummy_bytes)
         mock_image_open.assert_called_once_with(mock_bytesio_instance)
         mock_print_image_from_pil.assert_called_once_with(
-            mock_image_instance, self.mock_binary_io, on_progress=mock_on_progress
+            mock_image_instance, self.mock_binary_io, on_progress=mock_on_progress, trace=None,
+            orientation="portrait",
         )
 
 
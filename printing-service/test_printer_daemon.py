@@ -0,0 +1,428 @@
+import base64
+import cProfile
+import glob
+import marshal
+import os
+import pstats
+import queue
+import socket
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+from unittest.mock import patch
+from PIL import Image
+
+import printer_daemon
+from ipc import DaemonError, dump_profile, load_profile, read_message, write_message
+from printer import PRINTER_WIDTH, prepare_image
+
+
+def _prepared_png(height: int = 10) -> str:
+    # Base64 PNG as sent by the HTTP workers
+    buf = BytesIO()
+    prepare_image(Image.new("RGB", (PRINTER_WIDTH, height), color="white")).save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+class DaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        with printer_daemon._jobs_lock:
+            printer_daemon._jobs.clear()
+        while True:
+            try:
+                printer_daemon._job_queue.get_nowait()
+            except queue.Empty:
+                break
+        printer_daemon._block_seconds = printer_daemon.BLOCK_SECONDS
+
+    def tearDown(self):
+        with printer_daemon._jobs_lock:
+            jobs = list(printer_daemon._jobs.values())
+            printer_daemon._jobs.clear()
+        for job in jobs:
+            if os.path.exists(job.path):
+                os.remove(job.path)
+
+
+class TestIpc(unittest.TestCase):
+    def test_message_round_trip(self):
+        buf = BytesIO()
+        msg = {"op": "submit", "params": {"lines": 3, "trace": {"decode": 0.5}}}
+
+        write_message(buf, msg)
+        write_message(buf, {"ok": True})
+        buf.seek(0)
+
+        self.assertEqual(read_message(buf), msg)
+        self.assertEqual(read_message(buf), {"ok": True})
+        self.assertIsNone(read_message(buf))
+
+    def test_profile_round_trip(self):
+        prof = cProfile.Profile()
+        prof.enable()
+        prepare_image(Image.new("RGB", (64, 64)))
+        prof.disable()
+
+        stats = pstats.Stats(load_profile(dump_profile(prof)))
+
+        self.assertTrue(any(name == "prepare_image" for _, _, name in stats.stats))
+
+
+class TestRequestHandler(DaemonTestCase):
+    def _request(self, raw: bytes):
+        server_end, client_end = socket.socketpair()
+        with server_end, client_end:
+            client_end.sendall(raw)
+            client_end.shutdown(socket.SHUT_WR)
+            printer_daemon._RequestHandler(server_end, None, None)
+            with client_end.makefile("rb") as f:
+                return read_message(f)
+
+    def test_unknown_op(self):
+        resp = self._request(b'{"op": "explode", "params": {}}\n')
+
+        self.assertFalse(resp["ok"])
+        self.assertEqual(resp["status"], 400)
+        self.assertIn("explode", resp["detail"])
+
+    def test_malformed_request(self):
+        for raw in (b"not json\n", b"[1, 2]\n", b'{"op": "jobs", "params": 5}\n'):
+            resp = self._request(raw)
+            self.assertFalse(resp["ok"])
+            self.assertEqual(resp["status"], 400)
+
+    def test_daemon_error_passed_through(self):
+        resp = self._request(b'{"op": "job", "params": {"job_id": "missing"}}\n')
+
+        self.assertEqual(resp["status"], 404)
+
+    def test_known_op(self):
+        resp = self._request(b'{"op": "jobs", "params": {}}\n')
+
+        self.assertEqual(resp, {"ok": True, "result": {"jobs": []}})
+
+
+class TestJobs(DaemonTestCase):
+    def test_submit_creates_job(self):
+        result = printer_daemon.op_submit(_prepared_png(), 10, orientation="landscape", trace={"decode": 0.25})
+
+        job = printer_daemon._jobs[result["job_id"]]
+        self.assertEqual(job.status, "queued")
+        self.assertEqual(job.total, 10)
+        self.assertEqual(job.orientation, "landscape")
+        self.assertEqual(job.trace, {"decode": 0.25})
+        self.assertEqual(printer_daemon._job_queue.get_nowait(), job.id)
+        # The daemon owns the job file
+        self.assertTrue(os.path.basename(job.path).startswith("phomemo_"))
+        with Image.open(job.path) as img:
+            self.assertEqual(img.size, (PRINTER_WIDTH, 10))
+
+    def _job_files(self):
+        return set(glob.glob(os.path.join(tempfile.gettempdir(), "phomemo_*")))
+
+    def _assert_rejected(self, *args, **kwargs):
+        files = self._job_files()
+        with self.assertRaises(DaemonError) as cm:
+            printer_daemon.op_submit(*args, **kwargs)
+        self.assertEqual(cm.exception.status, 400)
+        self.assertEqual(printer_daemon._jobs, {})
+        self.assertEqual(printer_daemon._http_profiles, {})
+        self.assertTrue(printer_daemon._job_queue.empty())
+        self.assertEqual(self._job_files(), files)
+
+    def test_submit_rejects_bad_image_data(self):
+        self._assert_rejected("not base64!", 10)
+        self._assert_rejected(base64.b64encode(b"not a png").decode("ascii"), 10)
+
+    def test_submit_rejects_unprepared_image(self):
+        # Wrong height for the announced line count
+        self._assert_rejected(_prepared_png(height=20), 10)
+        buf = BytesIO()
+        Image.new("RGB", (PRINTER_WIDTH, 10)).save(buf, format="PNG")
+        self._assert_rejected(base64.b64encode(buf.getvalue()).decode("ascii"), 10)
+
+    def test_submit_rejects_bad_profile(self):
+        self._assert_rejected(_prepared_png(), 10, profile=base64.b64encode(b"\x00").decode("ascii"))
+        self._assert_rejected(_prepared_png(), 10, profile="not base64!")
+        self._assert_rejected(_prepared_png(), 10, profile=base64.b64encode(marshal.dumps(5)).decode("ascii"))
+        self._assert_rejected(_prepared_png(), 10, profile=base64.b64encode(marshal.dumps({1: 2})).decode("ascii"))
+
+    def test_submit_keeps_valid_profile(self):
+        prof = cProfile.Profile()
+        prof.enable()
+        prepare_image(Image.new("RGB", (64, 64)))
+        prof.disable()
+
+        result = printer_daemon.op_submit(_prepared_png(), 10, profile=dump_profile(prof))
+
+        self.assertIsInstance(printer_daemon._http_profiles.pop(result["job_id"]), pstats.Stats)
+
+    def test_submit_rolls_back_on_unexpected_error(self):
+        files = self._job_files()
+        with patch.object(printer_daemon._job_queue, "put", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                printer_daemon.op_submit(_prepared_png(), 10)
+        self.assertEqual(printer_daemon._jobs, {})
+        self.assertEqual(self._job_files(), files)
+
+    @patch("printer_daemon.time.time", return_value=1000.0)
+    def test_job_ids_are_unique(self, mock_time):
+        with printer_daemon._jobs_lock:
+            a = printer_daemon._new_job_locked("a.png", 1, "portrait", None)
+            b = printer_daemon._new_job_locked("b.png", 1, "portrait", None)
+            c = printer_daemon._new_job_locked("c.png", 1, "portrait", None)
+
+        self.assertEqual(a.id, "job_1000000")
+        self.assertEqual(len({a.id, b.id, c.id}), 3)
+
+
+class TestEtaAndAdmission(DaemonTestCase):
+    def setUp(self):
+        super().setUp()
+        printer_daemon._block_seconds = 2.0
+
+    def _add_job(self, lines, status="queued", done=0):
+        with printer_daemon._jobs_lock:
+            job = printer_daemon._new_job_locked("unused.png", lines, "portrait", None)
+            job.status = status
+            job.done = done
+        return job
+
+    def _eta(self, job):
+        with printer_daemon._jobs_lock:
+            return printer_daemon._eta_locked(job)
+
+    def _admit_error(self, lines):
+        with self.assertRaises(DaemonError) as cm:
+            printer_daemon.op_admit(lines)
+        return cm.exception
+
+    def test_eta_counts_blocks_ahead(self):
+        first = self._add_job(300)  # 2 blocks
+        second = self._add_job(100)  # 1 block
+        third = self._add_job(256)  # 1 block
+
+        self.assertEqual(self._eta(first), 4.0)
+        self.assertEqual(self._eta(second), 6.0)
+        self.assertEqual(self._eta(third), 8.0)
+
+    def test_queue_order_ignores_clock(self):
+        ids = [printer_daemon.op_submit(_prepared_png(), 10)["job_id"] for _ in range(3)]
+        # Clock stepped back between submissions
+        for i, job_id in enumerate(ids):
+            printer_daemon._jobs[job_id].created_at = 1000.0 - i
+
+        queued = [printer_daemon._job_queue.get_nowait() for _ in ids]
+        with printer_daemon._jobs_lock:
+            active = [j.id for j in printer_daemon._active_jobs_locked()]
+        self.assertEqual(active, queued)
+        self.assertEqual(active, ids)
+
+    def test_eta_of_partly_printed_job(self):
+        printing = self._add_job(600, status="printing", done=256)  # 344 left, 2 blocks
+        queued = self._add_job(10)
+
+        self.assertEqual(self._eta(printing), 4.0)
+        self.assertEqual(self._eta(queued), 6.0)
+
+    def test_eta_of_finished_job(self):
+        self.assertIsNone(self._eta(self._add_job(10, status="done", done=10)))
+        self.assertIsNone(self._eta(self._add_job(10, status="error")))
+
+    @patch("printer_daemon.QUEUE_MAX_LINES", 0)
+    @patch("printer_daemon.QUEUE_MAX_JOBS", 2)
+    def test_job_limit(self):
+        self._add_job(300)
+        self.assertTrue(printer_daemon.op_admit(10)["ok"])
+        self._add_job(100)
+
+        e = self._admit_error(10)
+
+        self.assertEqual(e.status, 429)
+        # Room once the first job (2 blocks) has printed
+        self.assertEqual(e.headers, {"Retry-After": "4"})
+
+    @patch("printer_daemon.QUEUE_MAX_LINES", 500)
+    @patch("printer_daemon.QUEUE_MAX_JOBS", 0)
+    def test_line_limit(self):
+        self._add_job(300)
+        self._add_job(100)
+        self.assertTrue(printer_daemon.op_admit(100)["ok"])
+
+        e = self._admit_error(200)
+
+        self.assertEqual(e.status, 429)
+        self.assertEqual(e.headers, {"Retry-After": "4"})
+
+    @patch("printer_daemon.QUEUE_MAX_LINES", 500)
+    @patch("printer_daemon.QUEUE_MAX_JOBS", 0)
+    def test_oversized_image(self):
+        self.assertEqual(self._admit_error(501).status, 413)
+
+    @patch("printer_daemon.QUEUE_MAX_LINES", 0)
+    @patch("printer_daemon.QUEUE_MAX_JOBS", 0)
+    def test_zero_disables_limits(self):
+        for _ in range(50):
+            self._add_job(10000)
+
+        self.assertTrue(printer_daemon.op_admit(10 ** 6)["ok"])
+
+    @patch("printer_daemon.QUEUE_MAX_LINES", 0)
+    @patch("printer_daemon.QUEUE_MAX_JOBS", 1)
+    def test_submit_rechecks_limits(self):
+        self._add_job(10)
+
+        with self.assertRaises(DaemonError) as cm:
+            printer_daemon.op_submit(_prepared_png(), 10)
+
+        self.assertEqual(cm.exception.status, 429)
+        self.assertEqual(len(printer_daemon._jobs), 1)
+
+    @patch("printer_daemon._is_connected", return_value=True)
+    @patch("printer_daemon.QUEUE_MAX_LINES", 0)
+    @patch("printer_daemon.QUEUE_MAX_JOBS", 1)
+    def test_print_checks_limits(self, mock_connected):
+        self._add_job(10)
+
+        with self.assertRaises(DaemonError) as cm:
+            printer_daemon.op_print(_prepared_png(), 10)
+
+        self.assertEqual(cm.exception.status, 429)
+        self.assertIn("Retry-After", cm.exception.headers)
+        self.assertEqual(len(printer_daemon._jobs), 1)
+
+    def test_block_seconds_ema(self):
+        with printer_daemon._jobs_lock:
+            printer_daemon._record_block_time_locked(2, 10.0)  # 5 s per block
+        self.assertAlmostEqual(printer_daemon._block_seconds, 2.0 + printer_daemon._BLOCK_SECONDS_ALPHA * 3.0)
+
+        with printer_daemon._jobs_lock:
+            printer_daemon._record_block_time_locked(0, 10.0)
+        self.assertAlmostEqual(printer_daemon._block_seconds, 2.0 + printer_daemon._BLOCK_SECONDS_ALPHA * 3.0)
+
+
+class WorkerTestCase(DaemonTestCase):
+    # Runs the real print worker thread for the duration of a test
+    def setUp(self):
+        super().setUp()
+        printer_daemon._worker_stop_event.clear()
+        self.worker = threading.Thread(target=printer_daemon._print_worker_loop, daemon=True)
+        self.worker.start()
+
+    def tearDown(self):
+        printer_daemon._worker_stop_event.set()
+        self.worker.join(timeout=5)
+        printer_daemon._worker_stop_event.clear()
+        super().tearDown()
+
+    def _wait_finished(self, job_id):
+        with printer_daemon._jobs_cond:
+            self.assertTrue(printer_daemon._jobs_cond.wait_for(
+                lambda: printer_daemon._jobs[job_id].status in ("done", "error"), timeout=5
+            ))
+            return printer_daemon._jobs[job_id]
+
+
+@patch("printer_daemon._connect_bt_if_needed")
+@patch("printer_daemon._is_connected", return_value=False)
+class TestWorkerOffline(WorkerTestCase):
+    def test_offline_job_fails_and_removes_file(self, mock_connected, mock_connect):
+        job_id = printer_daemon.op_submit(_prepared_png(), 10)["job_id"]
+
+        job = self._wait_finished(job_id)
+
+        self.assertEqual(job.status, "error")
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(os.path.exists(job.path))
+
+
+@patch("printer_daemon.print_prepared_image_from_path")
+@patch("printer_daemon._is_connected", return_value=True)
+class TestWorkerSurvives(WorkerTestCase):
+    def tearDown(self):
+        printer_daemon.op_profile_start()
+        with printer_daemon._profile_lock:
+            printer_daemon._profile_remaining = 0
+        super().tearDown()
+
+    def test_profile_merge_failure(self, mock_connected, mock_print):
+        printer_daemon.op_profile_start(jobs=2)
+        with patch("printer_daemon._record_profile", side_effect=TypeError("bad stats")):
+            first = printer_daemon.op_submit(_prepared_png(), 10)["job_id"]
+            second = printer_daemon.op_submit(_prepared_png(), 10)["job_id"]
+
+            self.assertEqual(self._wait_finished(first).status, "done")
+            self.assertEqual(self._wait_finished(second).status, "done")
+        self.assertTrue(self.worker.is_alive())
+
+    def test_unexpected_error_fails_only_that_job(self, mock_connected, mock_print):
+        with patch.object(printer_daemon, "_http_profiles") as mock_profiles:
+            mock_profiles.pop.side_effect = [RuntimeError("boom"), None]
+            first = printer_daemon.op_submit(_prepared_png(), 10)["job_id"]
+            second = printer_daemon.op_submit(_prepared_png(), 10)["job_id"]
+
+            failed = self._wait_finished(first)
+            self.assertEqual(self._wait_finished(second).status, "done")
+        self.assertEqual(failed.status, "error")
+        self.assertIsNotNone(failed.finished_at)
+        self.assertFalse(os.path.exists(failed.path))
+        self.assertTrue(self.worker.is_alive())
+
+
+@patch("printer_daemon._is_connected", return_value=True)
+class TestSyncPrint(DaemonTestCase):
+    def _print_in_thread(self):
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = printer_daemon.op_print(_prepared_png(), 10)
+            except DaemonError as e:
+                outcome["error"] = e
+
+        t = threading.Thread(target=run)
+        t.start()
+        job_id = printer_daemon._job_queue.get(timeout=5)
+        return t, outcome, printer_daemon._jobs[job_id]
+
+    def _finish(self, job, status, error=None):
+        with printer_daemon._jobs_cond:
+            job.status = status
+            job.error = error
+            printer_daemon._jobs_cond.notify_all()
+
+    def test_wakes_up_when_done(self, mock_connected):
+        t, outcome, job = self._print_in_thread()
+        self.assertTrue(t.is_alive())
+
+        self._finish(job, "done")
+        t.join(timeout=5)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(outcome["result"]["lines"], 10)
+
+    def test_wakes_up_when_failed(self, mock_connected):
+        t, outcome, job = self._print_in_thread()
+
+        self._finish(job, "error", "paper out")
+        t.join(timeout=5)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(outcome["error"].status, 500)
+        self.assertIn("paper out", outcome["error"].detail)
+
+
+    @patch("printer_daemon.SYNC_PRINT_TIMEOUT_SEC", 0.05)
+    def test_times_out_with_job_still_queued(self, mock_connected):
+        t, outcome, job = self._print_in_thread()
+        t.join(timeout=5)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(outcome["error"].status, 504)
+        self.assertIn(job.id, outcome["error"].detail)
+        self.assertEqual(job.status, "queued")
+
+
+if __name__ == "__main__":
+    unittest.main()